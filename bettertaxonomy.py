@@ -16,10 +16,16 @@ import argparse
 import datetime
 import csv
 import sys
+import time
 import codecs
 
+import dwca
 import matchcontroller
 import matchers
+import previous
+import progress
+import snapshot
+import streams
 
 #
 # INITIALIZATION
@@ -27,6 +33,7 @@ import matchers
 
 # Start a timer.
 time_start = datetime.datetime.now()
+clock_start = time.time()
 
 # Store a single timestamp for all operations.
 timestamp = datetime.datetime.now().strftime("%x")
@@ -36,7 +43,7 @@ cmdline = argparse.ArgumentParser(description = 'Match taxonomic names')
 
 cmdline.add_argument('input', 
     nargs='?',
-    help = 'A CSV or plain text file containing taxonomic names. Defaults to stdin.')
+    help = 'A CSV or plain text file containing taxonomic names, optionally compressed with gzip, bzip2 or zstd, or a Darwin Core Archive. Defaults to stdin.')
 
 cmdline.add_argument('-fieldname',
     type=str,
@@ -55,35 +62,93 @@ cmdline.add_argument('-internal',
 cmdline.add_argument('-output',
     nargs=1,
     type=str,
-    help='Output file')
+    help='Output file; compressed if it ends in .gz, .bz2 or .zst')
+
+cmdline.add_argument('-snapshot',
+    type=str,
+    help='Snapshot created by prefetch.py; remote matchers are answered from it without any network calls')
+
+cmdline.add_argument('-previous',
+    type=str,
+    help='Output from a previous run; unchanged rows that were matched then will reuse those matches')
+
+cmdline.add_argument('-max-age',
+    type=int,
+    help='When using -previous, match rows again if their previous match is older than this many days')
+
+cmdline.add_argument('-deadline',
+    type=float,
+    help='Seconds this run may take; once they run out, remote matchers are skipped')
+
+cmdline.add_argument('-row-budget',
+    type=float,
+    help='Seconds each row may take; once they run out, remote matchers are skipped for that row')
+
+cmdline.add_argument('-requeue',
+    type=str,
+    help='With -deadline or -row-budget, write rows whose remote matchers were skipped to this file')
+
+cmdline.add_argument('-staged',
+    action='store_true',
+    help='Match every row against local matchers first, and then query remote matchers with the remaining names in batches. Reads the entire input into memory.')
+
+cmdline.add_argument('-threads',
+    type=int,
+    default=4,
+    help='With -staged, the number of batches sent to remote matchers at the same time')
+
+cmdline.add_argument('-progress',
+    type=float,
+    help='Report progress on stderr every this many seconds')
+
+cmdline.add_argument('-status-file',
+    type=str,
+    help='Overwrite this file with a progress report every -progress seconds (10 by default)')
+
+cmdline.add_argument('-sidecar',
+    action='store_true',
+    help='When reading a Darwin Core Archive, only write out the core ID, the name and the matched columns')
 
 args = cmdline.parse_args()
 
-# Set up the input stream.
+# Set up the input stream. Darwin Core Archives are read directly from
+# the zip file.
 input = None
+archive = None
 if args.input is None:
     #sys.stdin = codecs.getreader("utf-8")(sys.stdin)
     input = sys.stdin
+elif dwca.is_archive(args.input):
+    archive = dwca.Archive(args.input)
+    input = archive.open_core()
 else:
     #input = codecs.open(args.input, "r", "utf-8")
-    input = open(args.input, "r")
+    input = streams.open_input(args.input, "r")
 
 # Set up the output stream.
 output_file = None
 if args.output is None:
     output_file = sys.stdout
 else:
-    output_file = open(args.output, "w")
+    output_file = streams.open_output(args.output[0], "w")
 
 # Load the config file.
 config_file = args.config
 if config_file is None:
     config_file = "sources.example.ini"
 
-matchcontrol = matchcontroller.parseSources(config_file)
+# Load the snapshot, if there is one.
+matcher_snapshot = None
+if args.snapshot is not None:
+    matcher_snapshot = snapshot.Snapshot(args.snapshot)
+    sys.stderr.write("Snapshot loaded from {:s}, created on {:s}\n".format(
+        args.snapshot, matcher_snapshot.created
+    ))
+
+matchcontrol = matchcontroller.parseSources(config_file, matcher_snapshot)
 
-sys.stderr.write("Configuration loaded from {:s}, {:d} match lists configured:\n\t{:s}\n\n".format(
-    config_file, len(matchcontrol), str(matchcontrol)
+sys.stderr.write("Configuration loaded from {:s}, {:d} match lists configured using {:d} matchers:\n\t{:s}\n\n".format(
+    config_file, len(matchcontrol), len(matchcontrol.registry), str(matchcontrol)
 ))
 
 # Load the internal list.
@@ -95,6 +160,27 @@ else:
     ))
     internal_fieldname = internal_list.column_name()
 
+# Load the previous output file.
+previous_matches = None
+if args.previous is not None:
+    previous_matches = previous.PreviousMatches(
+        args.previous,
+        args.fieldname,
+        matchcontrol.condition_columns(),
+        datetime.timedelta(days=args.max_age) if args.max_age is not None else None
+    )
+    sys.stderr.write("{:d} matches loaded from previous file {:s}\n".format(
+        len(previous_matches), args.previous
+    ))
+
+if args.staged and (args.deadline is not None or args.row_budget is not None):
+    sys.stderr.write("Error: -staged cannot be used with -deadline or -row-budget\n")
+    exit(1)
+
+if args.sidecar and archive is None:
+    sys.stderr.write("Error: -sidecar can only be used with a Darwin Core Archive\n")
+    exit(1)
+
 #
 # READ INPUT FILE
 # 
@@ -108,20 +194,20 @@ match_count_by_matcher = dict()
 # Store names that could not be matched.
 unmatched = []
 
-# Figure out the file type of the input file.
-try:
-    # Try to sniff the file format.
-    dialect = csv.Sniffer().sniff(input.read(1024), delimiters="\t,;|")
-    input.seek(0)
-    reader = csv.DictReader(input, dialect=dialect)
-    header = reader.fieldnames
-
-except csv.Error as e:
-    # If the sniff fails, read it as a tab-delimited file ("csv.excel_tab")
-    input.seek(0)
-    header = [input.readline().rstrip()]
-    dialect = csv.excel_tab
-    reader = csv.DictReader(input, dialect=dialect, fieldnames=header)
+if archive is not None:
+    # The archive's meta.xml describes the format of the core file. If we're
+    # only writing a sidecar file, we only need the name and the columns
+    # used in conditions.
+    header = archive.fieldnames
+    dialect = archive.dialect()
+    if args.sidecar:
+        reader = archive.rows(input, [args.fieldname] + matchcontrol.condition_columns())
+    else:
+        reader = archive.rows(input)
+
+else:
+    # Figure out the file type of the input file.
+    (reader, header, dialect) = streams.sniff_reader(input)
 
 # Check that the fieldname exists.
 if header.count(args.fieldname) == 0:
@@ -134,19 +220,73 @@ if header.count(args.fieldname) == 0:
 # - matched_url: A URL to this entry in the database.
 # - matched_source: The source as reported by the database.
 output_header = header[:]
+if args.sidecar:
+    # A sidecar file is keyed by the core ID.
+    output_header = [dwca.ID_FIELDNAME, args.fieldname]
 output_header.insert(output_header.index(args.fieldname) + 1, 'matched_scname')
 output_header.insert(output_header.index(args.fieldname) + 2, 'matched_acname')
 output_header.insert(output_header.index(args.fieldname) + 3, 'matched_url')
 output_header.insert(output_header.index(args.fieldname) + 4, 'matched_source')
 
+# - matched_date: The date on which this row was matched. We only need this
+#   if we're reusing matches from a previous run.
+if previous_matches is not None:
+    output_header.insert(output_header.index(args.fieldname) + 5, previous.MATCHED_DATE_COLUMN)
+    today = datetime.date.today().strftime(previous.DATE_FORMAT)
+
+# Rows that run out of time are written to the requeue file, so that they
+# can be matched in full later.
+run_deadline = None
+if args.deadline is not None:
+    run_deadline = clock_start + args.deadline
+use_budget = args.deadline is not None or args.row_budget is not None
+
+requeue_file = None
+if args.requeue is not None:
+    requeue_file = streams.open_output(args.requeue, "w")
+    requeue = csv.DictWriter(requeue_file, header, dialect=dialect, extrasaction='ignore')
+    requeue.writeheader()
+
+skipped_count = 0
+skipped_count_by_matcher = dict()
+
 # Create a csv.writer for writing this file to output.
-output = csv.DictWriter(output_file, output_header, dialect)
+output = csv.DictWriter(output_file, output_header, dialect,
+    extrasaction='ignore' if args.sidecar else 'raise')
 output.writeheader()
 
 #
 # MATCH ROWS
 #
 
+# Report progress from a background thread.
+reporter = None
+if args.progress is not None or args.status_file is not None:
+    reporter = progress.ProgressReporter(
+        input,
+        args.progress if args.progress is not None else 10,
+        sys.stderr if args.progress is not None else None,
+        args.status_file
+    )
+    reporter.start()
+
+# In staged mode, we read every row and match them all at once, skipping
+# rows that can reuse a previous match. Once the input has been read, it
+# can't tell us how much is left, so match_staged() reports on its
+# progress instead.
+staged_results = None
+if args.staged:
+    reader = list(reader)
+    if reporter is not None:
+        reporter.stream = None
+    staged_indexes = [index for (index, row) in enumerate(reader)
+        if previous_matches is None or previous_matches.lookup(row[args.fieldname].strip(), row) is None]
+    staged_results = dict(zip(staged_indexes, matchcontrol.match_staged(
+        [(reader[index][args.fieldname].strip(), reader[index]) for index in staged_indexes],
+        args.threads,
+        reporter
+    )))
+
 for row in reader:
     # Find the scientific name.
     name = row[args.fieldname].strip()
@@ -156,9 +296,40 @@ for row in reader:
     matched_acname = None
     matched_url = None
     matched_source = None
+    matched_date = None
+
+    # Step 0. Reuse the match from the previous run, if there is one.
+    reused = None
+    if previous_matches is not None:
+        reused = previous_matches.lookup(name, row)
+
+    # Step 1. Use the MatchController generated from the configuration file,
+    # within the time budget if there is one.
+    budget = None
+    if reused is not None:
+        (match, matched_date) = reused
+    elif staged_results is not None:
+        match = staged_results[row_count]
+    else:
+        if use_budget:
+            budget = matchcontroller.Budget(run_deadline, args.row_budget)
+        match = matchcontrol.match(name, row, budget)
+
+    # Keep track of rows that ran out of time.
+    if budget is not None and len(budget.skipped) > 0:
+        skipped_count += 1
+        for matcher in budget.skipped:
+            matcher_name = str(matcher)
+            if matcher_name in skipped_count_by_matcher:
+                skipped_count_by_matcher[matcher_name] += 1
+            else:
+                skipped_count_by_matcher[matcher_name] = 1
+
+        if requeue_file is not None:
+            requeue.writerow(row)
+    else:
+        budget = None
 
-    # Step 1. Use the MatchController generated from the configuration file.
-    match = matchcontrol.match(name, row)
     if match is not None:
         # Match!
         match_count += 1
@@ -197,10 +368,16 @@ for row in reader:
                 match_count_by_matcher["internal"] = 1            
 
         else:
-            # Step 3. No match found. Store it for later.
-            unmatched.append(name)
+            # Step 3. No match found. Store it for later, unless we ran out
+            # of time before trying every matcher.
+            if budget is None:
+                unmatched.append(name)
             unmatched_count += 1
 
+    # Note any matchers we skipped.
+    if budget is not None:
+        matched_source = (matched_source + " " if matched_source else "") + budget.note()
+
     # scname and acname might be dicts, with (key: key_count) pairs.
     if type(matched_scname) == dict:
         matched_scname = sorted(matched_scname, key=matched_scname.get)[0]
@@ -216,10 +393,33 @@ for row in reader:
     except UnicodeDecodeError as e:
         raise RuntimeError("Could not decode unicode name from source " + matched_source.encode('utf-8') + ": " + str(e))
 
+    if previous_matches is not None:
+        if matched_date is None and match is not None:
+            matched_date = today
+        row[previous.MATCHED_DATE_COLUMN] = matched_date if matched_date is not None else ""
+
     # Write out the row.
     output.writerow(row)
     row_count+=1
 
+    if reporter is not None:
+        reporter.rows = row_count
+        reporter.matched = match_count
+
+if reporter is not None:
+    reporter.stop()
+
+# Compressed output streams need to be closed to be complete.
+if output_file is not sys.stdout:
+    output_file.close()
+
+if requeue_file is not None:
+    requeue_file.close()
+
+if archive is not None:
+    input.close()
+    archive.close()
+
 #
 # ADD UNMATCHED NAMES TO INTERNAL LIST
 # 
@@ -280,3 +480,21 @@ sys.stderr.write("""
     "\n".join(match_summary),
     unmatched_count, (float(unmatched_count)/row_count * 100),
 ))
+
+if matcher_snapshot is not None:
+    sys.stderr.write(" - Queries for names not in snapshot %s: %d\n" % (
+        args.snapshot,
+        matcher_snapshot.misses(matchcontrol.registry)
+    ))
+
+if use_budget:
+    skipped_summary = []
+    for matcher in skipped_count_by_matcher:
+        skipped_summary.append("\t{:s}: {:d}".format(matcher, skipped_count_by_matcher[matcher]))
+    skipped_summary.sort()
+
+    sys.stderr.write(" - Rows that ran out of time: %d (%.2f%%)%s, skipping these matchers:\n%s\n" % (
+        skipped_count, (float(skipped_count)/row_count * 100) if row_count > 0 else 0,
+        " written to " + args.requeue if args.requeue is not None else "",
+        "\n".join(skipped_summary)
+    ))
@@ -0,0 +1,140 @@
+#
+# dwca.py
+#
+# Reads Darwin Core Archives (http://rs.tdwg.org/dwc/terms/guides/text/), such
+# as GBIF occurrence downloads. The archive descriptor (meta.xml) is used to
+# find the core data file and its columns; the core file is then streamed
+# directly out of the zip file, so that it never needs to be extracted.
+#
+
+import csv
+import zipfile
+import xml.etree.ElementTree as ElementTree
+
+import streams
+
+# The namespace used in meta.xml.
+DWC_TEXT_NS = "{http://rs.tdwg.org/dwc/text/}"
+
+# The column name used for the core identifier (e.g. the occurrence ID).
+ID_FIELDNAME = "id"
+
+# Escape sequences used in the delimiter attributes in meta.xml.
+ESCAPES = {
+    "\\t": "\t",
+    "\\n": "\n",
+    "\\r": "\r",
+    "\\\"": "\"",
+    "\\'": "'"
+}
+
+# Converts a delimiter attribute from meta.xml (such as "\t") into the
+# character it represents. Returns None for an empty attribute.
+def _unescape(value):
+    if value is None or value == "":
+        return None
+    for (escaped, char) in ESCAPES.items():
+        value = value.replace(escaped, char)
+    return value
+
+# Returns the short name of a term, e.g. "scientificName" for
+# "http://rs.tdwg.org/dwc/terms/scientificName".
+def term_name(term):
+    return term.rstrip("/").split("/")[-1].split("#")[-1]
+
+# Tests whether a file is a Darwin Core Archive.
+def is_archive(filename):
+    if not zipfile.is_zipfile(filename):
+        return False
+    archive = zipfile.ZipFile(filename)
+    names = archive.namelist()
+    archive.close()
+    return "meta.xml" in names
+
+# An Archive represents a Darwin Core Archive. Only the core data file is
+# read; extensions are ignored.
+class Archive(object):
+    # Opens a Darwin Core Archive and parses its meta.xml.
+    def __init__(self, filename):
+        self.filename = filename
+        self.zip = zipfile.ZipFile(filename)
+
+        meta = ElementTree.fromstring(self.zip.read("meta.xml"))
+        core = meta.find(DWC_TEXT_NS + "core")
+        if core is None:
+            raise RuntimeError("No core file described in meta.xml in '{}'".format(filename))
+
+        self.row_type = core.get("rowType")
+        self.location = core.find(DWC_TEXT_NS + "files/" + DWC_TEXT_NS + "location").text.strip()
+        self.delimiter = str(_unescape(core.get("fieldsTerminatedBy", "\\t")) or "\t")
+        self.quotechar = _unescape(core.get("fieldsEnclosedBy", "\""))
+        if self.quotechar is not None:
+            self.quotechar = str(self.quotechar)
+        self.header_lines = int(core.get("ignoreHeaderLines", "0"))
+
+        id_elem = core.find(DWC_TEXT_NS + "id")
+        self.id_index = int(id_elem.get("index")) if id_elem is not None else None
+
+        # Every field has a short name, and either an index into each row
+        # or a default value (or both).
+        self.fields = []
+        for field in core.findall(DWC_TEXT_NS + "field"):
+            index = field.get("index")
+            self.fields.append((
+                term_name(field.get("term")),
+                int(index) if index is not None else None,
+                field.get("default", "")
+            ))
+
+        self.fieldnames = [ID_FIELDNAME] + [name for (name, index, default) in self.fields]
+
+    # Returns the csv.Dialect used by the core file.
+    def dialect(self):
+        class CoreDialect(csv.Dialect):
+            delimiter = self.delimiter
+            quotechar = self.quotechar
+            quoting = csv.QUOTE_NONE if self.quotechar is None else csv.QUOTE_MINIMAL
+            escapechar = None
+            doublequote = True
+            skipinitialspace = False
+            lineterminator = "\n"
+        return CoreDialect
+
+    # Opens the core file as a stream. The zip file is decompressed on a
+    # background thread.
+    def open_core(self):
+        info = self.zip.getinfo(self.location)
+        return streams.BackgroundReader(
+            self.zip.open(info),
+            self.filename + ":" + self.location,
+            info.file_size
+        )
+
+    # Returns a generator that produces a dict for every row in the core
+    # file, keyed by the short names of each term, and with the core
+    # identifier in the 'id' column.
+    #   - stream: the stream returned by open_core().
+    #   - fieldnames: if not None, only these columns are included.
+    def rows(self, stream, fieldnames=None):
+        fields = self.fields
+        if fieldnames is not None:
+            fields = [field for field in fields if field[0] in fieldnames]
+
+        reader = csv.reader(stream, dialect=self.dialect())
+        for i in range(self.header_lines):
+            next(reader, None)
+
+        for values in reader:
+            row = dict()
+            if self.id_index is not None:
+                row[ID_FIELDNAME] = values[self.id_index]
+            for (name, index, default) in fields:
+                if index is not None and index < len(values) and values[index] != "":
+                    row[name] = values[index]
+                else:
+                    row[name] = default
+            yield row
+
+    # Closes the archive.
+    def close(self):
+        self.zip.close()
@@ -2,14 +2,19 @@
 # http://www.gbif.org/developer/species
 
 
+import json         # To encode batch queries
 import requests     # HTTP library
 import sys          # So we can print to stderr
 
 # Path to the API.
 gbif_api_root = "http://api.gbif.org/v0.9";
 
-# Look up this name on a particular dataset.
-def get_matches(name, dataset = None):
+# Look up this name on a particular dataset. All of these functions accept
+# a timeout (in seconds) for each request; requests.Timeout is raised if it
+# is exceeded, even though a requests.ConnectTimeout is also a
+# requests.ConnectionError. Other connection errors are reported, and
+# treated as if there were no results, unless raise_errors is True.
+def get_matches(name, dataset = None, timeout = None, raise_errors = False):
     url = gbif_api_root + "/species"
 
     params={
@@ -21,8 +26,12 @@ def get_matches(name, dataset = None):
         params['datasetKey'] = dataset
 
     try:
-        response = requests.get(url, params=params)
-    except ConnectionError as e:
+        response = requests.get(url, params=params, timeout=timeout)
+    except requests.Timeout:
+        raise
+    except requests.ConnectionError as e:
+        if raise_errors:
+            raise
         sys.stderr.write("Connection error when querying '%s': %s\n" %
             (url, e)
         )
@@ -37,19 +46,58 @@ def get_matches(name, dataset = None):
 
     return results
 
+# Look up this name on every dataset, retrieving a single page of results.
+#
+# Returns: a tuple of (results, end_of_records), where end_of_records is
+# True if there are no more results after this page.
+def get_matches_page(name, limit = 100, offset = 0, timeout = None, raise_errors = False):
+    url = gbif_api_root + "/species"
+
+    params={
+        'name': name,
+        'strict': 'true',
+        'limit': limit,
+        'offset': offset
+    }
+
+    try:
+        response = requests.get(url, params=params, timeout=timeout)
+    except requests.Timeout:
+        raise
+    except requests.ConnectionError as e:
+        if raise_errors:
+            raise
+        sys.stderr.write("Connection error when querying '%s': %s\n" %
+            (url, e)
+        )
+        return ([], True)
+
+    # Throw an exception if something went wrong
+    response.raise_for_status()
+
+    # Parse response
+    json = response.json()
+    results = json['results']
+
+    return (results, json.get('endOfRecords', True) or len(results) == 0)
+
 # Look up this name using TaxRefine.
 def get_matches_from_taxrefine(name):
     url = "http://refine.taxonomics.org/gbifchecklists/reconcile"
 
     return get_matches_from_recon_url(url, name)
 
-def get_matches_from_recon_url(url, name):
+def get_matches_from_recon_url(url, name, timeout = None, raise_errors = False):
 
     try:
         response = requests.get(url, params = {
             'query': name
-        })
-    except ConnectionError as e:
+        }, timeout=timeout)
+    except requests.Timeout:
+        raise
+    except requests.ConnectionError as e:
+        if raise_errors:
+            raise
         sys.stderr.write("Connection error when querying '%s': %s\n" %
             (url, e)
         )
@@ -64,6 +112,30 @@ def get_matches_from_recon_url(url, name):
 
     return result
 
+# Look up several names in a single request to a reconciliation service,
+# using the "queries" parameter from the OpenRefine reconciliation API.
+# Unlike the functions above, connection errors are always raised, since
+# a failed request would otherwise look like a batch of unmatched names.
+#
+# Returns: a list containing the results for each name, in the same order
+# as the names.
+def get_batch_matches_from_recon_url(url, names):
+    queries = dict()
+    for (index, name) in enumerate(names):
+        queries["q" + str(index)] = {'query': name}
+
+    response = requests.post(url, data = {
+        'queries': json.dumps(queries)
+    })
+
+    # Throw an exception if something went wrong
+    response.raise_for_status()
+
+    # Parse response; results are keyed by the key of each query.
+    results = response.json()
+
+    return [results.get("q" + str(index), {}).get('result', []) for index in range(len(names))]
+
 # Convert a GBIF ID to a URL.
 def get_url_for_id(id): 
     # TODO: check that id is a number
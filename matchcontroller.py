@@ -10,6 +10,9 @@
 #       -> List of MatcherLists (queried first)
 #       -> Default MatcherList (queried last)
 #
+#   -> MatcherRegistry: builds each matcher in the configuration file once
+#       and shares it between every MatcherList that uses it.
+#
 #   -> MatcherList: handles a list of matchers
 #       -> variable: a variable to test
 #       -> condition: a value the variable must case-insensitively equal
@@ -20,27 +23,139 @@
 #
 
 import codecs
+import collections
 import ConfigParser 
-from matchers import Matcher, MatchResult
+import sys
+import time
+from matchers import Matcher, MatchResult, MatchError, MatchTimeout, GBIFMatcher, GBIFMatcherGroup
+import progress
+import workers
+
+# Marks the remote matchers skipped for a row in its matched_source.
+SKIPPED_MARKER = "[skipped: "
+
+# A Budget limits the time spent matching a single row. Once it runs out,
+# remote matchers are skipped (and recorded in 'skipped'), but local
+# matchers are still queried, so that the best local answer can be used.
+class Budget (object):
+    # Creates a Budget. Both limits are optional:
+    #   - deadline: the time (as returned by time.time()) by which the
+    #       entire run must be finished.
+    #   - row_budget: the number of seconds this row may take.
+    def __init__(self, deadline=None, row_budget=None):
+        self.expires = deadline
+        if row_budget is not None:
+            row_expires = time.time() + row_budget
+            if self.expires is None or row_expires < self.expires:
+                self.expires = row_expires
+        self.skipped = []
+
+    # Returns the number of seconds left, or None if there is no limit.
+    def remaining(self):
+        if self.expires is None:
+            return None
+        return max(0, self.expires - time.time())
+
+    # Records a remote matcher that was skipped.
+    def skip(self, matcher):
+        if matcher not in self.skipped:
+            self.skipped.append(matcher)
+
+    # Returns a note listing the skipped matchers, for use in matched_source.
+    def note(self):
+        return SKIPPED_MARKER + ", ".join(str(matcher) for matcher in self.skipped) + "]"
+
+# A MatcherRegistry creates one Matcher for every [matcher:*] section in the
+# configuration file that is used, the first time it is asked for. Every
+# MatcherList using the same matcher therefore shares a single Matcher, along
+# with its index, cache or connections.
+class MatcherRegistry (object):
+    # Creates a MatcherRegistry. Requires:
+    #   - config: The ConfigParser that is parsing the configuration file.
+    #   - snapshot: If not None, a Snapshot used to answer every remote
+    #       matcher instead of querying it.
+    def __init__(self, config, snapshot=None):
+        self.config = config
+        self.snapshot = snapshot
+        self.matchers = collections.OrderedDict()
+        self.groups = dict()
+
+    # Returns the Matcher with this name, building it if necessary.
+    def get(self, name):
+        if name not in self.matchers:
+            matcher = Matcher().build(self.config, name)
+            if self.snapshot is not None and matcher.remote:
+                matcher = self.snapshot.wrap(name, matcher)
+            self.matchers[name] = matcher
+        return self.matchers[name]
+
+    # Returns the GBIFMatcherGroup for a run of GBIFMatchers, creating it if
+    # necessary. MatcherLists with the same run of GBIFMatchers share a
+    # single group, just as they share the GBIFMatchers themselves.
+    def group(self, matchers):
+        key = tuple(id(matcher) for matcher in matchers)
+        if key not in self.groups:
+            self.groups[key] = GBIFMatcherGroup(matchers)
+        return self.groups[key]
+
+    # Returns a list of (name, Matcher) tuples for every Matcher built so far.
+    def items(self):
+        return list(self.matchers.items())
+
+    # Returns the number of Matchers built so far.
+    def __len__(self):
+        return len(self.matchers)
+
+# Plans how a list of Matchers will be queried. Consecutive GBIFMatchers are
+# combined into a single GBIFMatcherGroup, which queries GBIF once for all
+# of them instead of once per dataset. If a MatcherRegistry is provided,
+# groups are shared through it.
+#
+# Returns: a list of Matchers that returns the same results as the original
+# list when queried in order.
+def plan_matchers(matchers, registry=None):
+    plan = []
+    gbif_run = []
+
+    for matcher in matchers + [None]:
+        if isinstance(matcher, GBIFMatcher):
+            gbif_run.append(matcher)
+            continue
+
+        if len(gbif_run) > 1 and registry is not None:
+            plan.append(registry.group(gbif_run))
+        elif len(gbif_run) > 1:
+            plan.append(GBIFMatcherGroup(gbif_run))
+        else:
+            plan.extend(gbif_run)
+        gbif_run = []
+
+        if matcher is not None:
+            plan.append(matcher)
+
+    return plan
 
 # A MatcherList is a list of Matchers that are tested in sequence. Once a Matcher
 # matches a name, the search is terminated. A MatcherList can have a "condition" 
 # set as a combination of a column name and a value in that column; the test()
 # method can be used to check whether a row conforms to that condition.
+# Matchers are queried according to a plan (see plan_matchers()), which
+# may combine several of them into a single query.
 class MatcherList (object):
     # Creates a MatcherList. Requires:
-    #   - config: The ConfigParser that is parsing the configuration file.
+    #   - registry: The MatcherRegistry used to look up matchers.
     #   - name: The human-readable name of this matcher list.
     #   - The condition, consisting of:
     #       - column_name: The name of the column to be tested.
     #       - column_value: The value in that column that is a matching condition.
     #   - matchers_list: A list of Matchers.
-    def __init__(self, config, name, column_name, column_value, matchers_list):
+    def __init__(self, registry, name, column_name, column_value, matchers_list):
         self.name = name
         self.column_name = column_name
         self.column_value = column_value
         self.list_names = map(lambda x: x.strip(), matchers_list)
-        self.list_matchers = list(map(lambda x: Matcher().build(config, x), self.list_names))
+        self.list_matchers = list(map(lambda x: registry.get(x), self.list_names))
+        self.plan = plan_matchers(self.list_matchers, registry)
 
     # Returns the number of matchers.
     def __len__(self):
@@ -65,16 +180,31 @@ class MatcherList (object):
             return False
 
     # Match the scientific name provided. Dispatches the call to each of the
-    # matchers, in sequence.
+    # matchers, in sequence. If a Budget is provided, remote matchers are
+    # given the time remaining in it, and skipped once it runs out.
     #
     # Returns:
     #   - if a match was successful: a MatchResult
     #   - if a match was not successful: None
-    def match(self, scname):
+    def match(self, scname, budget=None):
         result = None
 
-        for matcher in self.list_matchers:
-            result = matcher.match(scname)
+        for matcher in self.plan:
+            if budget is not None and matcher.remote:
+                remaining = budget.remaining()
+                if remaining is not None and remaining <= 0:
+                    budget.skip(matcher)
+                    continue
+                try:
+                    result = progress.timed_match(matcher, scname, timeout=remaining)
+                except MatchTimeout:
+                    budget.skip(matcher)
+                    continue
+            elif matcher.remote:
+                result = progress.timed_match(matcher, scname)
+            else:
+                result = matcher.match(scname)
+
             if result is not None:
                 break
 
@@ -98,10 +228,12 @@ class EmptyMatcherList (MatcherList):
 # it therefore represents an entire configuration file. It is constructed by
 # the parseSources() method that is exposed directly from this module.
 class MatchController:
-    # Create an empty MatchController.
-    def __init__(self):
+    # Create an empty MatchController. The registry contains every Matcher
+    # used by its MatcherLists.
+    def __init__(self, registry=None):
         self.list = []
         self.default = EmptyMatcherList()
+        self.registry = registry
 
     # Add a MatcherList to MatchController.
     def add(self, matcherlist):
@@ -116,24 +248,119 @@ class MatchController:
     # MatchController.
     #   - scname: the scientific name to match.
     #   - row: the row that this scientific name is contained in.
+    #   - budget: if not None, a Budget limiting the time spent on this row.
     #
     # Returns:
     #   - if any of the Matchers matched: a MatchResult
     #   - if none of the Matchers matched: None
-    def match(self, scname, row = dict()):
+    def match(self, scname, row = dict(), budget = None):
         result = None
 
         for matchlist in self.list:
             if matchlist.test(row):
-                result = matchlist.match(scname)
+                result = matchlist.match(scname, budget)
                 if result is not None:
                     break
 
         if result is None:
-            result = self.default.match(scname)
+            result = self.default.match(scname, budget)
 
         return result
 
+    # Matches many names at once, in stages: every name is first matched
+    # against the local matchers that come before the first remote matcher
+    # in its plan. Then every remote matcher that names are waiting on is
+    # queried with all of those names at once (deduplicated, in batches of
+    # its batch_size, and with 'threads' batches running at the same
+    # time), and the process repeats with the names that are still
+    # unmatched. Each name is queried in the same order as match() would,
+    # so the results are identical. If a batch can't be queried, its names
+    # are queried one at a time instead, so that they are handled just as
+    # match() would handle them.
+    #   - items: a list of (scname, row) tuples.
+    #   - threads: the number of batches to query at the same time.
+    #   - reporter: if not None, a ProgressReporter to report each stage to.
+    #
+    # Returns: a list with a MatchResult or None for each item.
+    def match_staged(self, items, threads = 1, reporter = None):
+        # Every distinct combination of name and matching MatcherLists only
+        # needs to be matched once. Each state is a list of
+        # [scname, plan, position in plan, result].
+        states = collections.OrderedDict()
+        item_keys = []
+        for (scname, row) in items:
+            matchlists = [matchlist for matchlist in self.list if matchlist.test(row)]
+            key = (scname, tuple(id(matchlist) for matchlist in matchlists))
+            item_keys.append(key)
+
+            if key not in states:
+                plan = []
+                for matchlist in matchlists + [self.default]:
+                    plan.extend(matchlist.plan)
+                states[key] = [scname, plan, 0, None]
+
+        # Results from remote matchers, by matcher and then by name.
+        remote_results = dict()
+
+        pending = list(states.values())
+        stage = 0
+        while len(pending) > 0:
+            # Advance every state until it is matched, runs out of matchers, or
+            # reaches a remote matcher that hasn't been queried for its name.
+            waiting = collections.OrderedDict()
+            still_pending = []
+            for state in pending:
+                (scname, plan, position, result) = state
+                while result is None and position < len(plan):
+                    matcher = plan[position]
+                    if matcher.remote:
+                        cache = remote_results.setdefault(id(matcher), dict())
+                        if scname not in cache:
+                            waiting.setdefault(id(matcher), (matcher, set()))[1].add(scname)
+                            break
+                        result = cache[scname]
+                    else:
+                        result = matcher.match(scname)
+                    position += 1
+
+                state[2] = position
+                state[3] = result
+                if result is None and position < len(plan):
+                    still_pending.append(state)
+            pending = still_pending
+
+            # Query every remote matcher that names are waiting on.
+            batches = []
+            for (matcher, scnames) in waiting.values():
+                scnames = sorted(scnames)
+                for i in range(0, len(scnames), matcher.batch_size):
+                    batches.append((matcher, scnames[i:i + matcher.batch_size]))
+
+            stage += 1
+            if reporter is not None:
+                reporter.start_stage(stage, len(states), len(states) - len(pending), len(batches))
+
+            def query(batch):
+                (matcher, scnames) = batch
+                try:
+                    results = progress.timed_match_batch(matcher, scnames)
+                except MatchError as e:
+                    sys.stderr.write("Warning: {}; querying these {:d} names one at a time\n".format(e, len(scnames)))
+                    results = dict((scname, progress.timed_match(matcher, scname)) for scname in scnames)
+                if reporter is not None:
+                    reporter.finish_batch()
+                return (matcher, scnames, results)
+
+            for (matcher, scnames, results) in workers.parallel_map(query, batches, threads):
+                cache = remote_results[id(matcher)]
+                for scname in scnames:
+                    cache[scname] = results.get(scname)
+
+        if reporter is not None:
+            reporter.finish_stages()
+
+        return [states[key][3] for key in item_keys]
+
     # Matches a series of rows, using the column name 'scname_row'
     # The MatchResult is stored in a new column named '${scname_row}_match'.
     def matchRows(self, rows, scname_row):
@@ -153,6 +380,26 @@ class MatchController:
  
             row[scname_row + '_match'] = result
 
+    # Returns the list of Matchers that would be queried, in order, for a
+    # row: those in every MatcherList whose condition matches the row,
+    # followed by those in the default MatcherList.
+    def chain(self, row = dict()):
+        matchers = []
+        for matchlist in self.list:
+            if matchlist.test(row):
+                matchers.extend(matchlist.list_matchers)
+        matchers.extend(self.default.list_matchers)
+        return matchers
+
+    # Returns the names of the columns tested by the conditions on the
+    # MatcherLists in this MatchController.
+    def condition_columns(self):
+        columns = []
+        for matchlist in self.list:
+            if matchlist.column_name not in columns:
+                columns.append(matchlist.column_name)
+        return columns
+
     # Returns the number of MatcherLists in this MatchController.
     def __len__(self):
         return len(self.list) + 1
@@ -170,23 +417,26 @@ class MatchController:
                 "\n   - " + str(self.default)
 
 # Parses a .ini file and creates a sequence of matchers that follow
-# the sequence in the file.
-def parseSources(filename):
+# the sequence in the file. If a Snapshot is provided, remote matchers are
+# answered from it instead of being queried.
+def parseSources(filename, snapshot=None):
     config = ConfigParser.ConfigParser()
     config_file = codecs.open(filename, "r", "utf-8")
     config.readfp(config_file)
     config.optionxform = str # Makes all keys case-sensitive.
 
-    # Read the [matchers] section.
+    # Read the [matchers] section. Each matcher is only built once, no matter
+    # how many MatcherLists it appears in.
     matcher_keys = config.options('matchers')
-    matchc = MatchController()
+    registry = MatcherRegistry(config, snapshot)
+    matchc = MatchController(registry)
 
     for key in matcher_keys:
         if key == 'default':
-            matchc.set_default(MatcherList(config, key, None, None, config.get('matchers', key).split(',')))
+            matchc.set_default(MatcherList(registry, key, None, None, config.get('matchers', key).split(',')))
         else:
             (col_name, col_value) = key.split('~')
-            matchc.add(MatcherList(config, key, col_name.strip(), col_value.strip(), config.get('matchers', key).split(',')))
+            matchc.add(MatcherList(registry, key, col_name.strip(), col_value.strip(), config.get('matchers', key).split(',')))
 
     config_file.close()
 
@@ -12,15 +12,45 @@ FLAG_DEBUG = False
 # The root class of all Matchers. Use Matcher.build(...) to create a new Matcher
 # subclass for a given configuration.
 class Matcher(object):
+    # Remote Matchers query a web service; local Matchers don't.
+    remote = False
+
+    # The number of names a Matcher can usefully match in a single call to
+    # match_batch().
+    batch_size = 1
+
+    # If True, remote Matchers raise MatchError when their service can't be
+    # reached, instead of reporting the error and returning None as if the
+    # name had not been found.
+    raise_errors = False
+
     # Every Matcher has a name.
     def name(self):
         raise NotImplementedError("Matcher subclass did not implement name!")
     
+    # Remote Matchers return the host they query, so that Matchers that
+    # query the same host can share a rate limit. Local Matchers return None.
+    def service(self):
+        return None
+
     # Every Matcher can be matched against a scientific name, returning either
-    # a MatchResult or None.
+    # a MatchResult or None. Remote matchers also accept a 'timeout' (in
+    # seconds), and raise MatchTimeout if a query takes longer than that.
+    # See also raise_errors.
     def match(self, scname):
         raise NotImplementedError("Matcher subclass did not implement match!")
 
+    # Matches a list of scientific names. Subclasses that can match several
+    # names at once should override this; by default, we match each name
+    # in turn.
+    #
+    # Returns: a dict of scientific names to a MatchResult or None.
+    def match_batch(self, scnames):
+        results = dict()
+        for scname in scnames:
+            results[scname] = self.match(scname)
+        return results
+
     # Creates a configuration for a matcher with a particular name.
     #   - self: the Matcher() object (which we don't need).
     #   - config: a dict() contains configuration options for this Matcher.
@@ -61,8 +91,38 @@ class NullMatcher(Matcher):
     def __str__(self):
         return self.name + "*"
 
+# Raised by remote Matchers when their service could not be queried.
+class MatchError(Exception):
+    def __init__(self, matcher, error):
+        super(MatchError, self).__init__("Query to {} failed: {}".format(matcher, error))
+        self.matcher = matcher
+
+# Raised by remote Matchers when a query takes longer than its timeout.
+class MatchTimeout(MatchError):
+    def __init__(self, matcher, error):
+        Exception.__init__(self, "Query to {} timed out: {}".format(matcher, error))
+        self.matcher = matcher
+
+# Strings shared between many MatchResults (such as sources) are interned
+# here, so that we only keep a single copy of each. Only the first
+# INTERN_LIMIT distinct strings are kept, so that strings that turn out to
+# be unique to a single taxon can't fill up memory over a long run.
+INTERN_LIMIT = 10000
+_interned_strings = dict()
+
+def intern_string(string):
+    if string in _interned_strings:
+        return _interned_strings[string]
+    if len(_interned_strings) < INTERN_LIMIT:
+        _interned_strings[string] = string
+    return string
+
 # Models the result of a match. Wraps a bunch of properties of a match.
-class MatchResult:
+# We create one of these for every match, so we use __slots__ to avoid
+# creating a __dict__ for every instance.
+class MatchResult(object):
+    __slots__ = ('matcher', 'query', 'name_id', 'matched_name', 'accepted_name', 'source')
+
     # Creates a MatchResult. Requires:
     #   - matcher: The Matcher object used to match names.
     #   - query: The name being queried.
@@ -97,8 +157,13 @@ class MatchResult:
 
 # Matches this name against GBIF 
 import gbif_api
+import requests
+import time
+import urlparse
 
 class GBIFMatcher(Matcher):
+    remote = True
+
     # Creates an object given a GBIF ID and other options.
     # No other options are currently recognized.
     def __init__(self, name, gbif_id, options):
@@ -113,16 +178,27 @@ class GBIFMatcher(Matcher):
     def name(self):
         return self.name
 
+    # Returns the host of the GBIF API.
+    def service(self):
+        return urlparse.urlparse(gbif_api.gbif_api_root).netloc
+
     # Matches this name against GBIF.
-    def match(self, scname):
+    def match(self, scname, timeout=None):
         # Query GBIF.
-        matches = gbif_api.get_matches(scname, self.gbif_id)
+        try:
+            matches = gbif_api.get_matches(scname, self.gbif_id, timeout, self.raise_errors)
+        except requests.Timeout as e:
+            raise MatchTimeout(self, e)
+        except requests.ConnectionError as e:
+            raise MatchError(self, e)
 
         # Pick the first match.
         if len(matches) == 0:
             return None
-        result = matches[0]
+        return self.result(scname, matches[0])
 
+    # Constructs a MatchResult from a single result returned by GBIF.
+    def result(self, scname, result):
         # Set up a publishedIn if GBIF provides this to us.
         published_in = result['publishedIn'] if 'publishedIn' in result else ""
 
@@ -133,25 +209,104 @@ class GBIFMatcher(Matcher):
             gbif_api.get_url_for_id(result['key']),
             result['scientificName'],
             result['accepted'] if 'accepted' in result else "",
-            "(GBIF:{}) {}".format(self.name,
-                published_in + " " +
-                result['datasetKey']
-            )
+            self.source(published_in, result['datasetKey'])
         )
 
         return result
 
+    # Returns the source string for a match. Matches from the same
+    # publication and dataset share the same string, as far as
+    # intern_string() allows.
+    def source(self, published_in, dataset_key):
+        return intern_string("(GBIF:{}) {}".format(self.name,
+            published_in + " " +
+            dataset_key
+        ))
+
     # Returns a string object; we use "(GBIF)" after the name given to us.
     def __str__(self):
         return self.name + " (GBIF)"
 
+# A GBIFMatcherGroup queries GBIF once for several GBIFMatchers that would
+# otherwise be queried one after another, each for a different dataset. It
+# retrieves a single page of matches for a name without a dataset filter,
+# and then picks the first match from the first GBIFMatcher (in priority
+# order) whose dataset has one -- the same result as querying each
+# GBIFMatcher in turn. Most names are only found in a few datasets, so the
+# page usually contains every match. If it doesn't, any GBIFMatcher whose
+# dataset might be on a later page is queried directly instead, so we
+# never need more than one query per GBIFMatcher on top of the first.
+class GBIFMatcherGroup(Matcher):
+    remote = True
+
+    # The number of matches retrieved without a dataset filter.
+    page_size = 100
+
+    # Creates a GBIFMatcherGroup for a list of GBIFMatchers, in priority
+    # order.
+    def __init__(self, matchers):
+        self.matchers = matchers
+        self.name = ", ".join(matcher.name for matcher in matchers)
+
+    # Returns the names of the matchers in this group.
+    def name(self):
+        return self.name
+
+    # Matches this name against GBIF. MatchResults are reported as coming
+    # from the GBIFMatcher that would have matched them.
+    def match(self, scname, timeout=None):
+        datasets = set(matcher.gbif_id for matcher in self.matchers)
+        expires = None
+        if timeout is not None:
+            expires = time.time() + timeout
+
+        try:
+            (results, complete) = gbif_api.get_matches_page(scname, self.page_size,
+                timeout=timeout, raise_errors=self.raise_errors)
+        except requests.Timeout as e:
+            raise MatchTimeout(self, e)
+        except requests.ConnectionError as e:
+            raise MatchError(self, e)
+
+        # Find the first match in each dataset.
+        first_matches = dict()
+        for result in results:
+            dataset_key = result.get('datasetKey')
+            if dataset_key in datasets and dataset_key not in first_matches:
+                first_matches[dataset_key] = result
+
+        for matcher in self.matchers:
+            if matcher.gbif_id in first_matches:
+                return matcher.result(scname, first_matches[matcher.gbif_id])
+
+            # This dataset's matches might be on a later page.
+            if not complete:
+                remaining = None
+                if expires is not None:
+                    remaining = expires - time.time()
+                    if remaining <= 0:
+                        raise MatchTimeout(self, "no time left to query " + str(matcher))
+
+                result = matcher.match(scname, timeout=remaining)
+                if result is not None:
+                    return result
+
+        return None
+
+    # Returns a string object listing the GBIFMatchers in this group.
+    def __str__(self):
+        return ", ".join(str(matcher) for matcher in self.matchers)
+
 # Matches this name against GNA's name resolver (http://resolver.globalnames.org/)
 import urllib
 import urllib2
 import json
 import re
+import socket
 
 class GNAMatcher(Matcher):
+    remote = True
+
     # Creates an object given a GNA ID and other options.
     # No other options are currently recognized.
     def __init__(self, name, gna_ids, options):
@@ -166,18 +321,38 @@ class GNAMatcher(Matcher):
     def name(self):
         return self.name
 
+    # Returns the host of the GNA resolver.
+    def service(self):
+        return "resolver.globalnames.org"
+
     # Matches this name against the GNA resolver.
-    def match(self, scname):
+    def match(self, scname, timeout=None):
         # Query the GNA resolver.
-        stream = urllib2.urlopen("http://resolver.globalnames.org/name_resolvers.json",
-            data = urllib.urlencode({
-                "names": scname,
-                "preferred_data_sources": "|".join(self.gna_ids),
-                "best_match_only": "true"
-            })
-        )
-        results = json.load(stream)
-        stream.close()
+        kwargs = dict()
+        if timeout is not None:
+            kwargs['timeout'] = timeout
+
+        # The timeout also applies to reading the response, so we read it
+        # within the same try.
+        try:
+            stream = urllib2.urlopen("http://resolver.globalnames.org/name_resolvers.json",
+                data = urllib.urlencode({
+                    "names": scname,
+                    "preferred_data_sources": "|".join(self.gna_ids),
+                    "best_match_only": "true"
+                }),
+                **kwargs
+            )
+            try:
+                results = json.load(stream)
+            finally:
+                stream.close()
+        except socket.timeout as e:
+            raise MatchTimeout(self, e)
+        except urllib2.URLError as e:
+            if isinstance(e.reason, socket.timeout):
+                raise MatchTimeout(self, e)
+            raise
 
         if FLAG_DEBUG:
             print("QUERY: " + urllib.urlencode({
@@ -220,8 +395,16 @@ class GNAMatcher(Matcher):
 
 # ReconciliationMatcher: match against a reconciliation service
 class ReconciliationMatcher(Matcher):
+    remote = True
+
     # Creates an object given a recon_url and other options.
-    # No other options are currently recognized.
+    #
+    # Recognized options:
+    #   - name: The name to be used for this ReconciliationMatcher.
+    #   - batch_size: The number of names sent in each request by
+    #       match_batch() (default: 10). Callers such as prefetch.py and
+    #       MatchController.match_staged() send batches of this size
+    #       concurrently.
     def __init__(self, name, recon_url, options):
         if 'name' in options:
             self.name = options['name']
@@ -230,15 +413,50 @@ class ReconciliationMatcher(Matcher):
         self.recon_url = recon_url
         self.options = options
 
+        self.batch_size = int(options.get('batch_size', 10))
+
     # Returns the name of this matcher, as used in the configuration file.
     def name(self):
         return self.name
 
+    # Returns the host of the reconciliation service.
+    def service(self):
+        return urlparse.urlparse(self.recon_url).netloc
+
     # Matches this name against the reconciliation service.
-    def match(self, scname):
+    def match(self, scname, timeout=None):
         # Query the reconciliation service.
-        matches = gbif_api.get_matches_from_recon_url(self.recon_url, scname)
-
+        try:
+            matches = gbif_api.get_matches_from_recon_url(self.recon_url, scname, timeout, self.raise_errors)
+        except requests.Timeout as e:
+            raise MatchTimeout(self, e)
+        except requests.ConnectionError as e:
+            raise MatchError(self, e)
+        return self.result(scname, matches)
+
+    # Matches a list of names against the reconciliation service, sending
+    # batch_size names in each request. Raises MatchError if any request
+    # fails, whatever raise_errors is set to.
+    def match_batch(self, scnames):
+        scnames = list(scnames)
+        batches = [scnames[i:i + self.batch_size] for i in range(0, len(scnames), self.batch_size)]
+
+        results = dict()
+        for batch in batches:
+            try:
+                batch_matches = zip(batch, gbif_api.get_batch_matches_from_recon_url(self.recon_url, batch))
+            except requests.Timeout as e:
+                raise MatchTimeout(self, e)
+            except requests.RequestException as e:
+                raise MatchError(self, e)
+
+            for (scname, matches) in batch_matches:
+                results[scname] = self.result(scname, matches)
+        return results
+
+    # Constructs a MatchResult from the results returned by the
+    # reconciliation service for a name, or None if there weren't any.
+    def result(self, scname, matches):
         # Pick the first match.
         if len(matches) == 0:
             return None
@@ -283,7 +501,7 @@ class ReconciliationMatcher(Matcher):
             gbif_api.get_url_for_id(result['id']),
             name,
             accepted,
-            "(Recon:{}) {}".format(self.name, source.strip())
+            intern_string("(Recon:{}) {}".format(self.name, source.strip()))
         )
 
         return result
@@ -294,18 +512,50 @@ class ReconciliationMatcher(Matcher):
 
 # Look up this name in a file.
 import csv
+import os
+import threading
+import time
+import zlib
+import streams
 
 # Set the maximum field size to ... whatever.
 csv.field_size_limit(sys.maxsize)
 
+# The number of bytes at the start and end of a file used to check whether
+# it has only been appended to.
+CHECKSUM_BYTES = 4096
+
+# Returns a checksum of the start and the end of the first 'size' bytes of
+# a file.
+def _checksum(filename, size):
+    with open(filename, "rb") as f:
+        head = f.read(min(size, CHECKSUM_BYTES))
+        f.seek(max(0, size - CHECKSUM_BYTES))
+        tail = f.read(size - f.tell())
+    return zlib.crc32(head + tail)
+
 class FileMatcher(Matcher):
     # Creates a FileMatcher given a filename and other
     # configuration options.
     #
+    # The file may be compressed with gzip, bzip2 or zstd. It is checked for
+    # changes every reload_interval seconds: rows appended to an uncompressed
+    # file are added to the index, while any other change causes the file
+    # to be reloaded on a background thread.
+    #
     # Recognized options:
     #   - name: The name to be used for this FileMatcher.
     #   - column_name: The column containing scientificNames.
     #   - dialect: The dialect used to read this CSV file.
+    #   - reload_interval: How often (in seconds) to check whether the file
+    #       has changed (default: 10). Set to 0 to never check.
+    #   - higher_rank: A comma-separated list of ranks (such as "genus,
+    #       family") to fall back to when a name can't be matched exactly.
+    #       The genus is the first word of the name; it can be matched
+    #       against single-word names in this file (only those of rank
+    #       'genus', if there is a 'taxonRank' column) or against a 'genus'
+    #       column. Other ranks are matched against the column with the
+    #       same name. Column names are not case-sensitive.
     def __init__(self, name, filename, options):
         if 'name' in options:
             self.name = options['name']
@@ -325,7 +575,20 @@ class FileMatcher(Matcher):
         if 'dialect' in options:
             self.dialect = csv.get_dialect(options['dialect'])
 
+        self.reload_interval = float(options.get('reload_interval', 10))
+
+        self.higher_ranks = []
+        if options.get('higher_rank', '').strip() != '':
+            self.higher_ranks = [rank.strip().lower() for rank in options['higher_rank'].split(',')]
+        self.higher_rank_sources = dict((rank, intern_string(self.name + " (" + rank + " match)"))
+            for rank in self.higher_ranks)
+
         self.names = None
+        self.index = None
+        self.file_state = None
+        self.failed_state = None
+        self.next_check = 0
+        self.rebuilding = False
 
     # Return the name of this FileMatcher.
     def name(self):
@@ -348,48 +611,249 @@ class FileMatcher(Matcher):
         else:
             return self.fieldnames
 
-    # Attempts to match the scientific name against this file.
+    # Loads the entire file into self.names, a dict() that forms an index to
+    # every row in this file. To save memory, each row is stored as a tuple
+    # of (row_index, values), where values is a tuple of the values in each
+    # column; use row() to get a row as a dict. Values other than the
+    # scientific name are interned, as classification columns repeat the
+    # same few values many times.
+    def load(self):
+        self._swap(*self._read())
+        self.next_check = time.time() + self.reload_interval
+
+    # Reads the entire file.
     #
-    # Returns: a MatchResult if the name could be matched, otherwise None.
-    def match(self, query_scname):
-        # self.names is a dict() that forms an index to every row in this
-        # file; if it is not set, we load the entire file first.
-        if self.names == None:
-            self.names = dict()
-
-            csvfile = open(self.filename, "rb")
-            reader = csv.DictReader(csvfile, dialect=self.dialect)
-            self.fieldnames = reader.fieldnames
-
-            row_index = 0
-            for row in reader:
-                row_index += 1
-
-                scname = row[self.namecol]
-
-                if scname is None:
-                    raise RuntimeError('No column "{0:s}" on row {1:d}'.format(
-                        self.namecol, row_index
-                    ))
-                elif scname in self.names:
-                    raise RuntimeError('Duplicate scientificName detected: "{0:s}"'.format(scname))
-                else:
-                    row['_row_index'] = row_index
-                    self.names[scname] = row
+    # Returns: a tuple of (index, file_state), where:
+    #   - index is a tuple of (names, fieldnames, name_index, accepted_index,
+    #       ranks); see _index_ranks() for ranks.
+    #   - file_state is a tuple of (size, mtime, checksum, row_count,
+    #       appendable), describing the part of the file that was read.
+    def _read(self):
+        names = dict()
+        stat = os.stat(self.filename)
+        compressed = streams.detect_compression(self.filename) is not None
+
+        csvfile = streams.open_input(self.filename)
+        reader = csv.reader(csvfile, dialect=self.dialect)
+        fieldnames = next(reader, [])
+
+        if self.namecol not in fieldnames:
+            raise RuntimeError('No column "{0:s}" in file {1:s}'.format(self.namecol, self.filename))
+        name_index = fieldnames.index(self.namecol)
+
+        accepted_index = None
+        if 'acceptedName' in fieldnames:
+            accepted_index = fieldnames.index('acceptedName')
+
+        row_count = self._index_rows(reader, names, name_index, 0)
+        ranks = dict((rank, dict()) for rank in self.higher_ranks)
+        self._index_ranks(names, fieldnames, name_index, ranks)
+
+        # We can only add appended rows to an uncompressed file whose last
+        # line was complete.
+        size = stat.st_size if compressed else csvfile.tell()
+        csvfile.close()
+
+        appendable = False
+        if not compressed:
+            with open(self.filename, "rb") as f:
+                f.seek(max(0, size - 1))
+                appendable = (size == 0 or f.read(1) == b"\n")
+
+        return (
+            (names, fieldnames, name_index, accepted_index, ranks),
+            (size, stat.st_mtime, _checksum(self.filename, size), row_count, appendable)
+        )
 
-            csvfile.close()
+    # Adds every row from a csv.reader to 'names'.
+    #   - existing: names already indexed, which may not be repeated.
+    #   - row_index: the index of the last row already indexed.
+    #
+    # Returns: the index of the last row.
+    def _index_rows(self, reader, names, name_index, row_index, existing=dict()):
+        for values in reader:
+            # Skip blank lines, as csv.DictReader does.
+            if not values:
+                continue
+
+            row_index += 1
+
+            if name_index >= len(values):
+                raise RuntimeError('No column "{0:s}" on row {1:d}'.format(
+                    self.namecol, row_index
+                ))
+
+            scname = values[name_index]
+            if scname in names or scname in existing:
+                raise RuntimeError('Duplicate scientificName detected: "{0:s}"'.format(scname))
+
+            values = tuple(value if index == name_index else intern(value)
+                for (index, value) in enumerate(values))
+            names[scname] = (row_index, values)
+
+        return row_index
+
+    # Adds the rows in 'entries' (a dict in the same format as self.names)
+    # to 'ranks', a dict with a dict for every rank in higher_ranks. Each of
+    # those maps a name at that rank to the first row that contains it. For
+    # genera, this is either a single-word name in the file or a value in
+    # the 'genus' column; for other ranks, it's a value in the column with
+    # the same name. Names already in 'ranks' are not replaced.
+    def _index_ranks(self, entries, fieldnames, name_index, ranks):
+        if len(ranks) == 0:
+            return
+
+        lower_fieldnames = [fieldname.lower() for fieldname in fieldnames]
+        rank_columns = [(rank, lower_fieldnames.index(rank)) for rank in ranks
+            if rank in lower_fieldnames]
+
+        rank_index = None
+        if 'taxonrank' in lower_fieldnames:
+            rank_index = lower_fieldnames.index('taxonrank')
+
+        for entry in sorted(entries.values()):
+            values = entry[1]
+
+            if 'genus' in ranks and " " not in values[name_index].strip():
+                if rank_index is None or (rank_index < len(values) and values[rank_index].lower() == 'genus'):
+                    ranks['genus'].setdefault(values[name_index].strip(), entry)
+
+            for (rank, column) in rank_columns:
+                if column < len(values) and values[column] != "":
+                    ranks[rank].setdefault(values[column], entry)
+
+    # Replaces the index. Lookups use self.index, which is replaced in a
+    # single assignment, so they see either the old index or the new one.
+    def _swap(self, index, file_state):
+        self.names = index[0]
+        self.fieldnames = index[1]
+        self.accepted_index = index[3]
+        self.file_state = file_state
+        self.index = index
+
+    # Checks whether the file has changed since it was read. Appended rows
+    # are indexed immediately; if the file has changed in any other way, it
+    # is reloaded on a background thread, and lookups continue to use the
+    # old index until the new one is ready.
+    def check(self):
+        self.next_check = time.time() + self.reload_interval
+        if self.rebuilding:
+            return
+
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return
+
+        (size, mtime, checksum, row_count, appendable) = self.file_state
+        if (stat.st_size, stat.st_mtime) in [(size, mtime), self.failed_state]:
+            return
+
+        try:
+            if appendable and stat.st_size > size and _checksum(self.filename, size) == checksum:
+                self._append(stat)
+                return
+        except (RuntimeError, IOError, csv.Error) as e:
+            self._failed(stat, e)
+            return
+
+        self.rebuilding = True
+        thread = threading.Thread(target=self._rebuild, args=(stat,), name="reload:" + self.filename)
+        thread.daemon = True
+        thread.start()
+
+    # Indexes the rows appended to the file since it was read.
+    def _append(self, stat):
+        (names, fieldnames, name_index, accepted_index, ranks) = self.index
+        (size, mtime, checksum, row_count, appendable) = self.file_state
+
+        with open(self.filename, "rb") as f:
+            f.seek(size)
+            tail = f.read(stat.st_size - size)
+
+        # Leave any incomplete line for next time.
+        tail = tail[:tail.rfind(b"\n") + 1]
+        if len(tail) == 0:
+            return
+
+        additions = dict()
+        row_count = self._index_rows(
+            csv.reader(tail.splitlines(True), dialect=self.dialect),
+            additions, name_index, row_count, names
+        )
+        names.update(additions)
+        self._index_ranks(additions, fieldnames, name_index, ranks)
+
+        size += len(tail)
+        self.file_state = (size, stat.st_mtime, _checksum(self.filename, size), row_count, True)
+
+    # Reloads the entire file and swaps in the new index. Runs on a
+    # background thread.
+    def _rebuild(self, stat):
+        try:
+            self._swap(*self._read())
+        except (RuntimeError, IOError, OSError, csv.Error) as e:
+            self._failed(stat, e)
+        finally:
+            self.rebuilding = False
+
+    # Reports a file that could not be reloaded, and keeps using the old
+    # index until the file changes again.
+    def _failed(self, stat, error):
+        self.failed_state = (stat.st_size, stat.st_mtime)
+        sys.stderr.write("Warning: could not reload {}, continuing with the previous version: {}\n".format(
+            self.filename, error
+        ))
+
+    # Returns the row containing a scientific name as a dict, or None if
+    # this name is not in this file. As with csv.DictReader, the row index
+    # is stored in '_row_index', and missing values are set to None.
+    def row(self, scname):
+        if self.index is None:
+            self.load()
+
+        (names, fieldnames, name_index, accepted_index, ranks) = self.index
+        if scname not in names:
+            return None
+        (row_index, values) = names[scname]
 
-        # Match the query scientific name against self.names.
+        row = dict.fromkeys(fieldnames)
+        row.update(zip(fieldnames, values))
+        row['_row_index'] = row_index
+        return row
+
+    # Attempts to match the scientific name against this file. If it can't
+    # be matched exactly, we fall back to each of the higher_ranks in turn;
+    # these matches are marked as "(genus match)" (etc.) in their source,
+    # and their matched name is the name at that rank.
+    #
+    # Returns: a MatchResult if the name could be matched, otherwise None.
+    def match(self, query_scname):
+        # If the file has not been loaded yet, load it now; otherwise, check
+        # whether it has changed every reload_interval seconds.
+        if self.index is None:
+            self.load()
+        elif self.reload_interval > 0 and time.time() >= self.next_check:
+            self.check()
+
+        # Match the query scientific name against the index.
+        (names, fieldnames, name_index, accepted_index, ranks) = self.index
         result = None
-        if query_scname in self.names:
-            row = self.names[query_scname]
+        if query_scname not in names and len(ranks) > 0:
+            result = self.match_higher_rank(query_scname, ranks, name_index, accepted_index)
+        elif query_scname in names:
+            (row_index, values) = names[query_scname]
+
+            accepted = ""
+            if accepted_index is not None:
+                accepted = values[accepted_index] if accepted_index < len(values) else None
 
             result = MatchResult(
                 self,
                 query_scname,
-                self.filename + "#" + str(row['_row_index']),
+                self.filename + "#" + str(row_index),
                 query_scname,
-                row['acceptedName'] if ('acceptedName' in row) else "",
+                accepted,
                 self.name
             )
         else:
@@ -397,8 +861,37 @@ class FileMatcher(Matcher):
 
         return result
 
+    # Matches the first word of a name against the higher rank index.
+    #
+    # Returns: a MatchResult if the name could be matched, otherwise None.
+    def match_higher_rank(self, query_scname, ranks, name_index, accepted_index):
+        words = query_scname.split(None, 1)
+        if len(words) == 0:
+            return None
+        higher_name = words[0]
+
+        for rank in self.higher_ranks:
+            if higher_name in ranks[rank]:
+                (row_index, values) = ranks[rank][higher_name]
+
+                # The accepted name only applies if this row is the
+                # higher-rank name itself.
+                accepted = ""
+                if accepted_index is not None and values[name_index].strip() == higher_name:
+                    accepted = values[accepted_index] if accepted_index < len(values) else None
+
+                return MatchResult(
+                    self,
+                    query_scname,
+                    self.filename + "#" + str(row_index),
+                    higher_name,
+                    accepted,
+                    self.higher_rank_sources[rank]
+                )
+
+        return None
+
     # Returns a string representation of the filename. We use the filename
     # path to distinguish us from others.
     def __str__(self):
         return self.name + " (" + self.filename + ")"
-
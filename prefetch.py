@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+#
+# prefetch.py - query remote taxonomic sources ahead of time
+#
+# Reads the names in an input file, queries every remote matcher that
+# bettertaxonomy.py could use for each of them, and writes the results to
+# a snapshot file. Running bettertaxonomy.py with -snapshot then matches
+# names without making any network calls.
+#
+# Find out more at https://github.com/gaurav/bettertaxonomy
+#
+
+import argparse
+import collections
+import datetime
+import sys
+
+import dwca
+import matchcontroller
+import snapshot
+import streams
+import workers
+
+# Start a timer.
+time_start = datetime.datetime.now()
+
+# Read and parse the command line.
+cmdline = argparse.ArgumentParser(description = 'Query remote taxonomic sources and save the results to a snapshot')
+
+cmdline.add_argument('input',
+    help = 'A CSV or plain text file containing taxonomic names, optionally compressed, or a Darwin Core Archive.')
+
+cmdline.add_argument('-fieldname',
+    type=str,
+    help='The field containing scientific names to match',
+    default = 'scientificName')
+
+cmdline.add_argument('-config',
+    type=str,
+    help='Configuration file (see sources.example.ini for an example)')
+
+cmdline.add_argument('-output',
+    type=str,
+    required=True,
+    help='Snapshot file to write; compressed if it ends in .gz, .bz2 or .zst')
+
+cmdline.add_argument('-threads',
+    type=int,
+    default=8,
+    help='The number of queries to run at the same time')
+
+cmdline.add_argument('-rate',
+    type=float,
+    default=10,
+    help='The maximum number of queries per second sent to each matcher, unless it sets rate_limit')
+
+args = cmdline.parse_args()
+
+# Load the config file.
+config_file = args.config
+if config_file is None:
+    config_file = "sources.example.ini"
+
+matchcontrol = matchcontroller.parseSources(config_file)
+registry = matchcontrol.registry
+
+# Names that could not be queried must be left out of the snapshot, rather
+# than recorded as unmatched, so remote matchers need to raise errors.
+for (key, matcher) in registry.items():
+    matcher.raise_errors = True
+
+#
+# COLLECT NAMES
+#
+
+# Open the input file.
+archive = None
+if dwca.is_archive(args.input):
+    archive = dwca.Archive(args.input)
+    input = archive.open_core()
+    header = archive.fieldnames
+    reader = archive.rows(input, [args.fieldname] + matchcontrol.condition_columns())
+else:
+    input = streams.open_input(args.input, "r")
+    (reader, header, dialect) = streams.sniff_reader(input)
+
+if header.count(args.fieldname) == 0:
+    sys.stderr.write("Error: could not find field '{}' in file {}\n".format(args.fieldname, input.name))
+    exit(1)
+
+# The configuration file name of every matcher.
+matcher_keys = dict((id(matcher), key) for (key, matcher) in registry.items())
+
+# For every remote matcher, the set of names it might be asked to match.
+names_by_matcher = collections.OrderedDict()
+for (key, matcher) in registry.items():
+    if matcher.remote:
+        names_by_matcher[key] = set()
+
+row_count = 0
+for row in reader:
+    row_count += 1
+    name = row[args.fieldname].strip()
+    for matcher in matchcontrol.chain(row):
+        if matcher.remote:
+            names_by_matcher[matcher_keys[id(matcher)]].add(name)
+
+input.close()
+if archive is not None:
+    archive.close()
+
+#
+# QUERY REMOTE MATCHERS
+#
+
+# Split the names for each matcher into batches of matcher.batch_size, and
+# interleave the batches for different matchers so that we query them all
+# at the same time.
+batches_by_matcher = []
+for (key, names) in names_by_matcher.items():
+    matcher = registry.get(key)
+    names = sorted(names)
+    batches_by_matcher.append([(key, names[i:i + matcher.batch_size])
+        for i in range(0, len(names), matcher.batch_size)])
+
+# Matchers that query the same service (such as every GBIF matcher) share a
+# single RateLimiter, using the lowest rate_limit set on any of them.
+rates_by_service = collections.OrderedDict()
+for key in names_by_matcher:
+    matcher = registry.get(key)
+    rate = float(matcher.options.get('rate_limit', args.rate))
+    if rate > 0:
+        rates_by_service.setdefault(matcher.service(), []).append(rate)
+    else:
+        rates_by_service.setdefault(matcher.service(), [])
+
+limiters = dict()
+for (service, rates) in rates_by_service.items():
+    limiters[service] = workers.RateLimiter(min(rates) if len(rates) > 0 else None)
+
+batches = []
+for i in range(max([len(b) for b in batches_by_matcher] + [0])):
+    for matcher_batches in batches_by_matcher:
+        if i < len(matcher_batches):
+            batches.append(matcher_batches[i])
+
+sys.stderr.write("Querying {:d} names from {:d} rows against {:d} remote matchers in {:d} batches.\n".format(
+    len(set().union(*names_by_matcher.values())), row_count, len(names_by_matcher), len(batches)
+))
+
+# Query a single batch. Errors are reported rather than raised, so that a
+# failing batch doesn't stop the others.
+def fetch(batch):
+    (key, names) = batch
+    limiters[registry.get(key).service()].wait()
+    try:
+        return (key, names, registry.get(key).match_batch(names), None)
+    except Exception as e:
+        return (key, names, dict(), e)
+
+results = collections.OrderedDict((key, dict()) for key in names_by_matcher)
+error_count = 0
+error_names = set()
+for (key, names, matches, error) in workers.parallel_map(fetch, batches, args.threads):
+    if error is not None:
+        error_count += 1
+        error_names.update(names)
+        sys.stderr.write("Error querying {}: {}\n".format(key, error))
+    results[key].update(matches)
+
+snapshot.save(args.output, results)
+
+#
+# REPORT ON THE RESULTS
+#
+
+time_taken = (datetime.datetime.now() - time_start)
+
+summary = []
+for (key, matches) in results.items():
+    summary.append("\t{:s}: {:d} of {:d} names queried, {:d} matched".format(
+        str(registry.get(key)),
+        len(matches),
+        len(names_by_matcher[key]),
+        len([result for result in matches.values() if result is not None])
+    ))
+
+sys.stderr.write("""
+ - Snapshot written to %s in %s time.
+ - Results by matcher:
+%s
+ - Batches that could not be queried: %d, containing %d names (these are not in the snapshot)
+""" % (
+    args.output,
+    str(time_taken),
+    "\n".join(summary),
+    error_count,
+    len(error_names)
+))
@@ -0,0 +1,110 @@
+#
+# previous.py
+#
+# Loads the output of an earlier run of bettertaxonomy.py, so that rows that
+# have not changed since then can reuse their matches instead of being
+# matched again.
+#
+
+import datetime
+import os
+
+import streams
+from matchcontroller import SKIPPED_MARKER
+from matchers import MatchResult
+
+# The columns written out for every match.
+MATCHED_COLUMNS = ['matched_scname', 'matched_acname', 'matched_url', 'matched_source']
+
+# The column recording the date on which a row was matched.
+MATCHED_DATE_COLUMN = 'matched_date'
+
+# The format used in the MATCHED_DATE_COLUMN.
+DATE_FORMAT = "%Y-%m-%d"
+
+# The matched_source of names matched by the -internal list.
+INTERNAL_SOURCE = 'internal'
+
+# PreviousMatches indexes the matched rows in a previous output file by their
+# name and the values in their condition columns. Rows that could not be
+# matched, that were only matched by the -internal list (which is where
+# names that couldn't be matched end up), or that ran out of time before
+# every matcher was tried, are not indexed, so that they will be matched
+# again.
+class PreviousMatches(object):
+    # Loads a previous output file. Requires:
+    #   - filename: the previous output file.
+    #   - fieldname: the column containing scientific names.
+    #   - columns: the condition columns, which must be unchanged for a
+    #       match to be reused. Columns missing from the previous file are
+    #       ignored.
+    #   - max_age: if not None, a datetime.timedelta; matches older than
+    #       this are not reused.
+    #
+    # Rows without a matched_date column are dated by the modification time
+    # of the previous file.
+    def __init__(self, filename, fieldname, columns, max_age=None):
+        self.filename = filename
+        self.fieldname = fieldname
+        self.matches = dict()
+
+        file_date = datetime.date.fromtimestamp(os.path.getmtime(filename)).strftime(DATE_FORMAT)
+        oldest = None
+        if max_age is not None:
+            oldest = (datetime.date.today() - max_age).strftime(DATE_FORMAT)
+
+        stream = streams.open_input(filename)
+        (reader, header, dialect) = streams.sniff_reader(stream)
+
+        if fieldname not in header:
+            raise RuntimeError("Could not find field '{}' in previous file {}".format(fieldname, filename))
+        for column in MATCHED_COLUMNS:
+            if column not in header:
+                raise RuntimeError("Could not find column '{}' in previous file {}".format(column, filename))
+        self.columns = [column for column in columns if column in header]
+
+        for row in reader:
+            if row['matched_scname'] == "" and row['matched_url'] == "":
+                continue
+            if row['matched_source'] == INTERNAL_SOURCE or SKIPPED_MARKER in row['matched_source']:
+                continue
+
+            date = row.get(MATCHED_DATE_COLUMN) or file_date
+            if oldest is not None and date < oldest:
+                continue
+
+            self.matches[self._key(row[fieldname].strip(), row)] = (
+                MatchResult(
+                    self,
+                    row[fieldname],
+                    row['matched_url'].decode("utf-8"),
+                    row['matched_scname'].decode("utf-8"),
+                    row['matched_acname'].decode("utf-8"),
+                    row['matched_source'].decode("utf-8")
+                ),
+                date
+            )
+
+        stream.close()
+
+    # Returns the key for a name in a row.
+    def _key(self, scname, row):
+        return (scname,) + tuple(row.get(column, "") for column in self.columns)
+
+    # Looks up a name in the previous file.
+    #   - scname: the scientific name to look up.
+    #   - row: the row that this scientific name is contained in.
+    #
+    # Returns:
+    #   - if this row was matched previously: a tuple of (MatchResult, date)
+    #   - otherwise: None
+    def lookup(self, scname, row):
+        return self.matches.get(self._key(scname, row))
+
+    # Returns the number of matches that could be reused.
+    def __len__(self):
+        return len(self.matches)
+
+    # Reused matches are reported as coming from the previous file.
+    def __str__(self):
+        return "previous run (" + self.filename + ")"
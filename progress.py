@@ -0,0 +1,221 @@
+#
+# progress.py
+#
+# Keeps track of how remote matchers are performing, and periodically
+# reports on the progress of a run from a background thread. The main loop
+# only needs to update a couple of counters on the ProgressReporter, so
+# reporting doesn't slow matching down.
+#
+
+import collections
+import datetime
+import os
+import sys
+import threading
+import time
+
+import streams
+
+# Statistics for a single remote matcher.
+class SourceStats(object):
+    def __init__(self, name):
+        self.name = name
+        self.in_flight = 0
+        self.requests = 0
+        self.names = 0
+        self.hits = 0
+        self.latency = 0.0
+        self.lock = threading.Lock()
+
+    # Records a request that has started.
+    def start(self):
+        with self.lock:
+            self.in_flight += 1
+
+    # Records a request for 'names' names that took 'latency' seconds and
+    # matched 'hits' of them.
+    def finish(self, names, hits, latency):
+        with self.lock:
+            self.in_flight -= 1
+            self.requests += 1
+            self.names += names
+            self.hits += hits
+            self.latency += latency
+
+    # Summarizes these statistics on a single line.
+    def __str__(self):
+        return "{}: {:d} in flight, {:.3f}s/request, {:.1f}% hits".format(
+            self.name,
+            self.in_flight,
+            self.latency / self.requests if self.requests > 0 else 0,
+            float(self.hits) / self.names * 100 if self.names > 0 else 0
+        )
+
+# Statistics for every remote matcher that has been queried, by matcher.
+sources = collections.OrderedDict()
+sources_lock = threading.Lock()
+
+# Returns the SourceStats for a matcher, creating it if necessary.
+def stats_for(matcher):
+    key = id(matcher)
+    if key not in sources:
+        with sources_lock:
+            if key not in sources:
+                sources[key] = SourceStats(str(matcher))
+    return sources[key]
+
+# Calls matcher.match(), recording statistics for the matcher.
+def timed_match(matcher, scname, **kwargs):
+    stats = stats_for(matcher)
+    stats.start()
+    start = time.time()
+    result = None
+    try:
+        result = matcher.match(scname, **kwargs)
+        return result
+    finally:
+        stats.finish(1, 1 if result is not None else 0, time.time() - start)
+
+# Calls matcher.match_batch(), recording statistics for the matcher.
+def timed_match_batch(matcher, scnames):
+    stats = stats_for(matcher)
+    stats.start()
+    start = time.time()
+    results = dict()
+    try:
+        results = matcher.match_batch(scnames)
+        return results
+    finally:
+        stats.finish(
+            len(scnames),
+            len([result for result in results.values() if result is not None]),
+            time.time() - start
+        )
+
+# A ProgressReporter runs on a background thread, and reports on progress
+# every 'interval' seconds. The main loop should set 'rows' and 'matched'
+# as it goes. In staged mode, MatchController.match_staged() reports on
+# each stage with start_stage() and finish_batch().
+class ProgressReporter(threading.Thread):
+    # Creates a ProgressReporter. Requires:
+    #   - stream: the input stream, used to estimate how much is left, or
+    #       None if this can't be estimated from the input (for instance,
+    #       because it has already been read into memory).
+    #   - interval: the number of seconds between reports.
+    #   - output: the stream to write reports to, or None.
+    #   - status_file: a file to overwrite with each report, or None.
+    def __init__(self, stream, interval, output=sys.stderr, status_file=None):
+        super(ProgressReporter, self).__init__(name="progress")
+        self.daemon = True
+
+        self.stream = stream
+        self.interval = interval
+        self.output = output
+        self.status_file = status_file
+
+        self.rows = 0
+        self.matched = 0
+
+        # The current stage in staged mode, or None.
+        self.stage = None
+        self.lock = threading.Lock()
+
+        self.time_start = time.time()
+        self.last_time = self.time_start
+        self.last_rows = 0
+        self.stopped = threading.Event()
+
+    # Reports every 'interval' seconds until stopped.
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    # Stops reporting, after writing out a final report.
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.report()
+
+    # Records the start of a stage in staged mode.
+    #   - stage: the number of this stage.
+    #   - names: the number of distinct names being matched.
+    #   - resolved: the number of names that have been matched or have run
+    #       out of matchers.
+    #   - batches: the number of batches that will be sent to remote
+    #       matchers in this stage.
+    def start_stage(self, stage, names, resolved, batches):
+        with self.lock:
+            self.stage = [stage, names, resolved, batches, 0]
+
+    # Records a batch that has been queried in the current stage.
+    def finish_batch(self):
+        with self.lock:
+            self.stage[4] += 1
+
+    # Records the end of staged matching.
+    def finish_stages(self):
+        with self.lock:
+            self.stage = None
+
+    # Returns a single line describing our progress.
+    def status(self):
+        now = time.time()
+        rows = self.rows
+        elapsed = now - self.time_start
+
+        current = (rows - self.last_rows) / (now - self.last_time) if now > self.last_time else 0
+        average = rows / elapsed if elapsed > 0 else 0
+        self.last_time = now
+        self.last_rows = rows
+
+        parts = [
+            "[{}] {:d} rows".format(datetime.timedelta(seconds=int(elapsed)), rows),
+            "{:.1f} rows/s now, {:.1f} rows/s average".format(current, average),
+            "{:.1f}% matched".format(float(self.matched) / rows * 100 if rows > 0 else 0)
+        ]
+
+        # In staged mode, we estimate how much is left from the number of
+        # names resolved so far.
+        with self.lock:
+            stage = list(self.stage) if self.stage is not None else None
+        fraction = None
+        if stage is not None:
+            (number, names, resolved, batches, batches_done) = stage
+            parts.append("stage {:d}: {:d} of {:d} names resolved, {:d} of {:d} batches queried".format(
+                number, resolved, names, batches_done, batches
+            ))
+            if names > 0:
+                fraction = float(resolved) / names
+        elif self.stream is not None:
+            fraction = streams.file_progress(self.stream)
+
+        if fraction is not None:
+            fraction = min(fraction, 1.0)
+            if fraction > 0:
+                parts.append("{:.1f}% {}, ETA {}".format(
+                    fraction * 100,
+                    "of names" if stage is not None else "of input",
+                    datetime.timedelta(seconds=int(elapsed / fraction - elapsed))
+                ))
+
+        parts.extend(str(stats) for stats in list(sources.values()))
+        return " | ".join(parts)
+
+    # Writes out a report.
+    def report(self):
+        line = self.status()
+
+        if self.output is not None:
+            self.output.write(line + "\n")
+            self.output.flush()
+
+        # Write the status file in full before renaming it into place, so
+        # that anything reading it never sees a partial report.
+        if self.status_file is not None:
+            temp_file = os.path.join(
+                os.path.dirname(os.path.abspath(self.status_file)),
+                "." + os.path.basename(self.status_file) + ".tmp"
+            )
+            with open(temp_file, "w") as f:
+                f.write(line + "\n")
+            os.rename(temp_file, self.status_file)
@@ -0,0 +1,130 @@
+#
+# snapshot.py
+#
+# Snapshots record the results of querying remote matchers for a list of
+# names, so that a later run can use them instead of querying the remote
+# service. Snapshots are created by prefetch.py, and are JSON files (which
+# may be compressed) in the following format:
+#
+#   {
+#     "format": "bettertaxonomy-snapshot",
+#     "version": 1,
+#     "created": "2014-06-25T12:00:00",
+#     "matchers": {
+#       "<matcher name>": {
+#         "<scientific name>": [name_id, matched_name, accepted_name, source],
+#         "<unmatched scientific name>": null
+#       }
+#     }
+#   }
+#
+# Matchers are identified by the name of their [matcher:*] section in the
+# configuration file.
+#
+
+import datetime
+import json
+import sys
+
+import streams
+from matchers import Matcher, MatchResult, intern_string
+
+SNAPSHOT_FORMAT = "bettertaxonomy-snapshot"
+SNAPSHOT_VERSION = 1
+
+# Converts a MatchResult into a list that can be stored in a snapshot.
+def result_to_entry(result):
+    if result is None:
+        return None
+    return [result.name_id, result.matched_name, result.accepted_name, result.source]
+
+# Writes a snapshot. Requires:
+#   - filename: the file to write to; compressed if it ends in .gz, .bz2 or .zst.
+#   - results: a dict of matcher names to dicts of scientific names to
+#       MatchResults or None.
+def save(filename, results):
+    matchers = dict()
+    for (matcher_name, matches) in results.items():
+        matchers[matcher_name] = dict(
+            (scname, result_to_entry(result)) for (scname, result) in matches.items()
+        )
+
+    output = streams.open_output(filename)
+    json.dump({
+        "format": SNAPSHOT_FORMAT,
+        "version": SNAPSHOT_VERSION,
+        "created": datetime.datetime.now().isoformat(),
+        "matchers": matchers
+    }, output)
+    output.close()
+
+# A Snapshot is a read-only set of results loaded from a snapshot file.
+class Snapshot(object):
+    # Loads a snapshot file.
+    def __init__(self, filename):
+        self.filename = filename
+
+        stream = streams.open_input(filename)
+        data = json.load(stream)
+        stream.close()
+
+        if data.get("format") != SNAPSHOT_FORMAT:
+            raise RuntimeError("'{}' is not a snapshot file".format(filename))
+        if data.get("version") != SNAPSHOT_VERSION:
+            raise RuntimeError("Snapshot file '{}' has unsupported version {}".format(filename, data.get("version")))
+
+        self.created = data["created"]
+        self.matchers = data["matchers"]
+
+    # Wraps a remote Matcher so that it is answered from this snapshot.
+    #   - name: the name of the matcher in the configuration file.
+    #   - matcher: the Matcher to wrap.
+    def wrap(self, name, matcher):
+        if name not in self.matchers:
+            sys.stderr.write("Warning: matcher '{}' is not in snapshot {}, so it will not match any names\n".format(
+                name, self.filename
+            ))
+        return SnapshotMatcher(matcher, self.matchers.get(name, dict()))
+
+    # Returns the total number of names not found in the snapshot by the
+    # SnapshotMatchers in a MatcherRegistry.
+    def misses(self, registry):
+        return sum(matcher.misses for (name, matcher) in registry.items()
+            if isinstance(matcher, SnapshotMatcher))
+
+# A SnapshotMatcher answers queries for a remote Matcher from a snapshot,
+# without making any network calls. Names that are not in the snapshot
+# cannot be matched.
+class SnapshotMatcher(Matcher):
+    # Creates a SnapshotMatcher. Requires:
+    #   - matcher: the remote Matcher whose results are in the snapshot.
+    #   - entries: a dict of scientific names to snapshot entries.
+    def __init__(self, matcher, entries):
+        self.matcher = matcher
+        self.name = matcher.name
+        self.entries = entries
+        self.misses = 0
+
+    # Returns the name of the wrapped matcher.
+    def name(self):
+        return self.name
+
+    # Looks up this name in the snapshot. MatchResults are reported as
+    # coming from the wrapped matcher, so that they are indistinguishable
+    # from those made by querying the remote service.
+    def match(self, scname):
+        key = scname.decode("utf-8") if isinstance(scname, bytes) else scname
+        if key not in self.entries:
+            self.misses += 1
+            return None
+
+        entry = self.entries[key]
+        if entry is None:
+            return None
+
+        (name_id, matched_name, accepted_name, source) = entry
+        return MatchResult(self.matcher, scname, name_id, matched_name, accepted_name, intern_string(source))
+
+    # Returns the name of the wrapped matcher, marked as coming from a snapshot.
+    def __str__(self):
+        return str(self.matcher) + " [snapshot]"
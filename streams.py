@@ -0,0 +1,339 @@
+#
+# streams.py
+#
+# Opens input, output and checklist files, transparently handling gzip, bzip2
+# and zstd compression. Compressed files are detected by their magic bytes
+# when reading and by their extension when writing. Decompression takes
+# place on a background thread, so that it overlaps with name matching.
+#
+
+import bz2
+import csv
+import gzip
+import itertools
+import os
+import Queue
+import threading
+
+# The size of each chunk read by the background thread.
+CHUNK_SIZE = 1024 * 1024
+
+# The maximum number of decompressed chunks waiting to be read.
+QUEUE_SIZE = 16
+
+# Magic bytes at the start of each compressed format we recognize.
+MAGIC_GZIP = b"\x1f\x8b"
+MAGIC_BZIP2 = b"BZh"
+MAGIC_ZSTD = b"\x28\xb5\x2f\xfd"
+
+# Extensions used to pick a compression format when writing.
+EXTENSIONS = {
+    ".gz": "gzip",
+    ".bz2": "bzip2",
+    ".zst": "zstd"
+}
+
+# zstd support requires the 'zstandard' package, which we only import if
+# we actually come across a zstd file.
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError("Reading or writing zstd files requires the 'zstandard' package, version 0.11 or later (try `pip install zstandard`)")
+    return zstandard
+
+# Works out the compression used in a file by reading its first few bytes.
+#
+# Returns: "gzip", "bzip2", "zstd", or None if the file is not compressed.
+def detect_compression(filename):
+    with open(filename, "rb") as f:
+        magic = f.read(4)
+
+    if magic.startswith(MAGIC_GZIP):
+        return "gzip"
+    elif magic.startswith(MAGIC_BZIP2):
+        return "bzip2"
+    elif magic.startswith(MAGIC_ZSTD):
+        return "zstd"
+    else:
+        return None
+
+# A BackgroundReader wraps a file-like object, and reads chunks from it on a
+# separate thread. It provides enough of the file interface (read(),
+# readline() and iteration) to be used by the csv module.
+class BackgroundReader(object):
+    # Creates a BackgroundReader. Requires:
+    #   - raw: the file-like object to read from. It will be closed when
+    #       this reader is closed.
+    #   - name: the name of the file being read, used in error messages.
+    #   - size: the total number of bytes we expect to read, if known.
+    #   - compressed: if size is not known, the compressed file that 'raw'
+    #       reads from, used to estimate how far through the file we are.
+    def __init__(self, raw, name, size=None, compressed=None):
+        self.name = name
+        self.size = size
+        self.bytes_read = 0
+        self.compressed = compressed
+
+        self._raw = raw
+        self._queue = Queue.Queue(QUEUE_SIZE)
+        self._buffer = b""
+        self._pos = 0
+        self._eof = False
+        self._error = None
+        self._closed = False
+
+        self._thread = threading.Thread(target=self._fill, name="reader:" + name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    # Runs on the background thread: reads chunks from the raw file into
+    # the queue, followed by None to indicate the end of the file.
+    def _fill(self):
+        try:
+            while not self._closed:
+                chunk = self._raw.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                self._queue.put(chunk)
+        except Exception as e:
+            self._error = e
+        finally:
+            self._queue.put(None)
+
+    # Takes the next chunk from the queue.
+    #
+    # Returns: the chunk, or None at the end of the file.
+    def _next_chunk(self):
+        if self._eof:
+            return None
+
+        chunk = self._queue.get()
+        if chunk is None:
+            self._eof = True
+            if self._error is not None:
+                raise IOError("Could not read from '{}': {}".format(self.name, self._error))
+            return None
+
+        self.bytes_read += len(chunk)
+        return chunk
+
+    # Moves the next chunk from the queue into the buffer. Only the unread
+    # part of the buffer is kept, which is usually no more than a line.
+    #
+    # Returns: True if more data was read, False at the end of the file.
+    def _more(self):
+        chunk = self._next_chunk()
+        if chunk is None:
+            return False
+
+        if self._pos >= len(self._buffer):
+            self._buffer = chunk
+        else:
+            self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    # Reads up to 'size' bytes, or the rest of the file if size is negative.
+    def read(self, size=-1):
+        # Small reads can usually be answered from the buffer.
+        if 0 <= size <= len(self._buffer) - self._pos:
+            data = self._buffer[self._pos:self._pos + size]
+            self._pos += size
+            return data
+
+        # Otherwise, collect chunks and join them once, so that reading a
+        # large file doesn't copy the buffer for every chunk.
+        chunks = [self._buffer[self._pos:]]
+        length = len(chunks[0])
+        while size < 0 or length < size:
+            chunk = self._next_chunk()
+            if chunk is None:
+                break
+            chunks.append(chunk)
+            length += len(chunk)
+
+        data = b"".join(chunks)
+        self._buffer = b""
+        self._pos = 0
+        if 0 <= size < len(data):
+            self._buffer = data[size:]
+            data = data[:size]
+        return data
+
+    # Reads a single line, including its trailing newline.
+    def readline(self):
+        while True:
+            end = self._buffer.find(b"\n", self._pos)
+            if end != -1:
+                line = self._buffer[self._pos:end + 1]
+                self._pos = end + 1
+                return line
+
+            if not self._more():
+                line = self._buffer[self._pos:]
+                self._pos = len(self._buffer)
+                return line
+
+    # Iterates over the lines in this file.
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    __next__ = next
+
+    # Returns the fraction of the file read so far, or None if we can't tell.
+    def progress(self):
+        if self.size:
+            return float(self.bytes_read) / self.size
+        elif self.compressed is not None:
+            return file_progress(self.compressed)
+        else:
+            return None
+
+    # Stops the background thread and closes the raw file.
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+
+        # Drain the queue so that the background thread isn't stuck on put().
+        while self._thread.is_alive():
+            try:
+                self._queue.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+        self._raw.close()
+        if self.compressed is not None:
+            self.compressed.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# Python 2's bz2.BZ2File stops at the end of the first bzip2 stream, but
+# files written by pbzip2 or lbzip2, or several bzip2 files concatenated
+# together, contain many streams. A MultiStreamBZ2Reader decompresses all
+# of them. It only provides read(), as it is only read by a
+# BackgroundReader.
+class MultiStreamBZ2Reader(object):
+    # Creates a MultiStreamBZ2Reader for a file opened in binary mode.
+    def __init__(self, raw):
+        self._raw = raw
+        self._decompressor = bz2.BZ2Decompressor()
+
+    # Decompresses up to 'size' bytes of compressed data.
+    #
+    # Returns: the decompressed data, or an empty string at the end of the
+    # file.
+    def read(self, size=CHUNK_SIZE):
+        while True:
+            compressed = self._raw.read(size)
+            if not compressed:
+                return b""
+
+            output = []
+            while compressed:
+                try:
+                    output.append(self._decompressor.decompress(compressed))
+                    compressed = self._decompressor.unused_data
+                except EOFError:
+                    # The previous stream ended exactly at the end of the
+                    # last block we read, so this is the start of a new one.
+                    pass
+                else:
+                    if not compressed:
+                        break
+                self._decompressor = bz2.BZ2Decompressor()
+
+            data = b"".join(output)
+            if data:
+                return data
+
+    def close(self):
+        self._raw.close()
+
+# Opens a file for reading. Compressed files are decompressed on a background
+# thread; uncompressed files are opened directly. Compressed files may
+# contain several streams (or frames), which are read one after another.
+def open_input(filename, mode="rb"):
+    compression = detect_compression(filename)
+
+    if compression is None:
+        return open(filename, mode)
+    elif compression == "gzip":
+        raw = open(filename, "rb")
+        return BackgroundReader(gzip.GzipFile(fileobj=raw, mode="rb"), filename, compressed=raw)
+    elif compression == "bzip2":
+        raw = open(filename, "rb")
+        return BackgroundReader(MultiStreamBZ2Reader(raw), filename, compressed=raw)
+    else:
+        raw = open(filename, "rb")
+        return BackgroundReader(
+            _zstandard().ZstdDecompressor().stream_reader(raw, read_across_frames=True),
+            filename,
+            compressed=raw
+        )
+
+# Returns the fraction of a file that has been read so far, or None if we
+# can't tell (for instance, because it is a pipe). This only looks at the
+# operating system's position in the file, so it is safe to call from
+# another thread.
+def file_progress(stream):
+    if isinstance(stream, BackgroundReader):
+        return stream.progress()
+
+    try:
+        fd = stream.fileno()
+        size = os.fstat(fd).st_size
+        if size == 0:
+            return None
+        return float(os.lseek(fd, 0, os.SEEK_CUR)) / size
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+
+# Opens a file for writing. Files whose names end in .gz, .bz2 or .zst
+# are compressed accordingly.
+def open_output(filename, mode="wb"):
+    compression = EXTENSIONS.get(os.path.splitext(filename)[1].lower())
+
+    if compression is None:
+        return open(filename, mode)
+    elif compression == "gzip":
+        return gzip.GzipFile(filename, "wb")
+    elif compression == "bzip2":
+        return bz2.BZ2File(filename, "wb")
+    else:
+        raw = open(filename, "wb")
+        return _zstandard().ZstdCompressor().stream_writer(raw)
+
+# Creates a csv.DictReader for a stream, sniffing its format. We can't seek on
+# compressed streams or stdin, so we read a sample (completed to the end of
+# its last line) and then chain it back in front of the rest of the stream.
+#
+# Returns: a tuple of (reader, header, dialect).
+def sniff_reader(stream):
+    sample = stream.read(1024)
+    sample += stream.readline()
+    lines = itertools.chain(sample.splitlines(True), stream)
+
+    try:
+        # Try to sniff the file format.
+        dialect = csv.Sniffer().sniff(sample, delimiters="\t,;|")
+        reader = csv.DictReader(lines, dialect=dialect)
+        header = reader.fieldnames
+
+    except csv.Error as e:
+        # If the sniff fails, read it as a tab-delimited file ("csv.excel_tab")
+        header = [next(lines).rstrip()]
+        dialect = csv.excel_tab
+        reader = csv.DictReader(lines, dialect=dialect, fieldnames=header)
+
+    return (reader, header, dialect)
@@ -0,0 +1,73 @@
+#
+# workers.py
+#
+# Helpers for querying remote matchers concurrently without overwhelming
+# them: a RateLimiter, and a parallel_map() that runs a function on a pool
+# of threads.
+#
+
+import Queue
+import threading
+import time
+
+# A RateLimiter spaces out calls so that no more than 'rate' calls are made
+# per second, across every thread that shares it.
+class RateLimiter(object):
+    # Creates a RateLimiter. If rate is None or zero, calls are not limited.
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_call = 0
+        self.lock = threading.Lock()
+
+    # Blocks until the next call may be made.
+    def wait(self):
+        if self.interval == 0:
+            return
+
+        with self.lock:
+            now = time.time()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+
+        if delay > 0:
+            time.sleep(delay)
+
+# Calls func(item) for every item, using a pool of threads.
+#
+# Returns: a list of the results, in the same order as the items. If func
+# raised an exception for any item, the first such exception is re-raised
+# once every item has been processed.
+def parallel_map(func, items, threads):
+    items = list(items)
+    results = [None] * len(items)
+    errors = []
+
+    if threads <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    queue = Queue.Queue()
+    for index in range(len(items)):
+        queue.put(index)
+
+    def work():
+        while True:
+            try:
+                index = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[index] = func(items[index])
+            except Exception as e:
+                errors.append(e)
+
+    pool = [threading.Thread(target=work) for i in range(min(threads, len(items)))]
+    for thread in pool:
+        thread.daemon = True
+        thread.start()
+    for thread in pool:
+        thread.join()
+
+    if len(errors) > 0:
+        raise errors[0]
+
+    return results